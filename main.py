@@ -14,16 +14,19 @@ from fastapi.exceptions import RequestValidationError
 
 from models import RequestModel, ImageGenerationRequest, AudioTranscriptionRequest, ModerationRequest, UnifiedRequest
 from request import get_payload
-from response import fetch_response, fetch_response_stream
-from utils import error_handling_wrapper, post_all_models, load_config, safe_get, circular_list_encoder
+from response import fetch_response_one, fetch_response_stream
+from utils import error_handling_wrapper, error_handling_response, post_all_models, load_config, safe_get, circular_list_encoder, build_provider_index
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import cycle, islice
+from functools import lru_cache
+from operator import itemgetter
 from typing import List, Dict, Union
-from urllib.parse import urlparse
 
 import os
 import string
 import json
+import orjson
 
 is_debug = bool(os.getenv("DEBUG", False))
 
@@ -82,8 +85,11 @@ async def lifespan(app: FastAPI):
         "User-Agent": "curl/7.68.0",  # 模拟 curl 的 User-Agent
         "Accept": "*/*",  # curl 的默认 Accept 头
     }
+    # 默认连接池只有 100 个连接、20 个 keep-alive，高并发时请求会排队等待连接
+    limits = httpx.Limits(max_connections=500, max_keepalive_connections=100, keepalive_expiry=30.0)
     app.state.client = httpx.AsyncClient(
         timeout=timeout,
+        limits=limits,
         headers=default_headers,
         http2=True,  # 禁用 HTTP/2
         verify=True,  # 保持 SSL 验证（如需禁用，设为 False，但不建议）
@@ -91,23 +97,41 @@ async def lifespan(app: FastAPI):
     )
     # app.state.client = httpx.AsyncClient(timeout=timeout)
     app.state.config, app.state.api_keys_db, app.state.api_list = await load_config(app)
+    # token 到 api_index 的映射，重复的 key 以第一次出现为准，与 list.index 一致
+    app.state.api_index_map = {api: index for index, api in reversed(list(enumerate(app.state.api_list)))}
+    app.state.admin_tokens = {api_key['api'] for api_key in app.state.api_keys_db if api_key.get('role') == "admin"}
+    app.state.provider_index = build_provider_index(app.state.config)
+    app.state.rate_limits = get_rate_limits(app.state.config)
+    stats_flush_task = asyncio.create_task(app.state.stats_middleware.flush_stats_periodically())
     yield
     # 关闭时的代码
+    stats_flush_task.cancel()
+    await app.state.stats_middleware.flush_stats()
     await app.state.client.aclose()
 
-app = FastAPI(lifespan=lifespan, debug=is_debug)
+# 用 orjson 序列化 JSON 响应，FastAPI 自带的 ORJSONResponse 已被标记为弃用
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except orjson.JSONEncodeError:
+            # orjson 不支持超过 64 位的整数等情况，回退到标准库，保证上游响应原样透传
+            return super().render(content)
+
+app = FastAPI(lifespan=lifespan, debug=is_debug, default_response_class=FastJSONResponse)
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     if exc.status_code == 404:
         logger.error(f"404 Error: {exc.detail}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=exc.status_code,
         content={"message": exc.detail},
     )
 
 import asyncio
 from time import time
+from datetime import datetime, timezone
 from collections import defaultdict
 from starlette.middleware.base import BaseHTTPMiddleware
 import json
@@ -122,7 +146,7 @@ async def parse_request_body(request: Request):
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Float, DateTime, select, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, select, insert, Boolean, Text
 from sqlalchemy.sql import func
 
 # 定义数据库模型
@@ -163,10 +187,29 @@ engine = create_async_engine('sqlite+aiosqlite:///' + db_path, echo=is_debug)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 class StatsMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
+    def __init__(self, app, app_state, flush_interval=5, max_pending_stats=10000, exclude_paths=None):
         super().__init__(app)
+        # 这些路径不做统计，也不做道德审查
+        self.exclude_paths = set(exclude_paths) if exclude_paths else {"/stats", "/generate-api-key"}
+        # 统计数据先写入内存缓冲区，由后台任务定时批量写入数据库
+        # 缓冲区有上限，写满后丢弃最旧的记录并计数，避免内存无限增长
+        self.max_pending_stats = max_pending_stats
+        self.pending_request_stats = deque(maxlen=max_pending_stats)
+        self.pending_channel_stats = deque(maxlen=max_pending_stats)
+        self.dropped_request_stats = 0
+        self.dropped_channel_stats = 0
+        self.flush_interval = flush_interval
+        # 缓冲区超过一半时提前唤醒写库任务，不必等到下一个定时周期
+        self.flush_threshold = max(max_pending_stats // 2, 1)
+        self.flush_event = asyncio.Event()
+        # 只在写库之间互斥，关闭时的最后一次写库会等待进行中的写库完成
+        self.flush_lock = asyncio.Lock()
+        app_state.stats_middleware = self
 
     async def dispatch(self, request: Request, call_next):
+        if request.url.path in self.exclude_paths:
+            return await call_next(request)
+
         start_time = time()
 
         endpoint = f"{request.method} {request.url.path}"
@@ -187,11 +230,10 @@ class StatsMiddleware(BaseHTTPMiddleware):
             token = None
         if token:
             try:
-                api_list = app.state.api_list
-                api_index = api_list.index(token)
+                api_index = app.state.api_index_map[token]
                 enable_moderation = safe_get(config, 'api_keys', api_index, "preferences", "ENABLE_MODERATION", default=False)
-            except ValueError:
-                # token不在api_list中，使用默认值（不开启）
+            except KeyError:
+                # token不在api_index_map中，使用默认值（不开启）
                 pass
         else:
             # 如果token为None，检查全局设置
@@ -217,8 +259,8 @@ class StatsMiddleware(BaseHTTPMiddleware):
                     if is_flagged:
                         logger.error(f"Content did not pass the moral check: %s", moderated_content)
                         process_time = time() - start_time
-                        await self.update_stats(endpoint, process_time, client_ip, model, token, is_flagged, moderated_content)
-                        return JSONResponse(
+                        self.update_stats(endpoint, process_time, client_ip, model, token, is_flagged, moderated_content)
+                        return FastJSONResponse(
                             status_code=400,
                             content={"error": "Content did not pass the moral check, please modify and try again."}
                         )
@@ -234,46 +276,78 @@ class StatsMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
         process_time = time() - start_time
 
-        # 异步更新数据库
-        await self.update_stats(endpoint, process_time, client_ip, model, token, is_flagged, moderated_content)
+        # 记录到缓冲区，由后台任务批量写入数据库
+        self.update_stats(endpoint, process_time, client_ip, model, token, is_flagged, moderated_content)
 
         return response
 
-    async def update_stats(self, endpoint, process_time, client_ip, model, token, is_flagged, moderated_content):
-        async with async_session() as session:
-            async with session.begin():
-                try:
-                    new_request_stat = RequestStat(
-                        endpoint=endpoint,
-                        ip=client_ip,
-                        token=token,
-                        total_time=process_time,
-                        model=model,
-                        is_flagged=is_flagged,
-                        moderated_content=moderated_content
-                    )
-                    session.add(new_request_stat)
-                    await session.commit()
-                except Exception as e:
-                    await session.rollback()
-                    logger.error(f"Error updating stats: {str(e)}")
-
-    async def update_channel_stats(self, provider, model, api_key, success, first_response_time):
-        async with async_session() as session:
-            async with session.begin():
-                try:
-                    channel_stat = ChannelStat(
-                        provider=provider,
-                        model=model,
-                        api_key=api_key,
-                        success=success,
-                        first_response_time=first_response_time
-                    )
-                    session.add(channel_stat)
-                    await session.commit()
-                except Exception as e:
-                    await session.rollback()
-                    logger.error(f"Error updating channel stats: {str(e)}")
+    def update_stats(self, endpoint, process_time, client_ip, model, token, is_flagged, moderated_content):
+        # 缓冲区只保存紧凑的元组，时间戳为 epoch 秒，写库时再转换为 datetime
+        if len(self.pending_request_stats) == self.max_pending_stats:
+            self.dropped_request_stats += 1
+        self.pending_request_stats.append((endpoint, client_ip, token, process_time, model, is_flagged, moderated_content, time()))
+        if len(self.pending_request_stats) >= self.flush_threshold:
+            self.flush_event.set()
+
+    def update_channel_stats(self, provider, model, api_key, success, first_response_time):
+        if len(self.pending_channel_stats) == self.max_pending_stats:
+            self.dropped_channel_stats += 1
+        self.pending_channel_stats.append((provider, model, api_key, success, first_response_time, time()))
+        if len(self.pending_channel_stats) >= self.flush_threshold:
+            self.flush_event.set()
+
+    async def flush_stats(self):
+        async with self.flush_lock:
+            # 没有新的统计数据时不打开数据库会话
+            if not self.pending_request_stats and not self.pending_channel_stats:
+                return
+            # 先交换缓冲区再写库，写库期间产生的新统计进入新的缓冲区
+            request_stats, self.pending_request_stats = self.pending_request_stats, deque(maxlen=self.max_pending_stats)
+            channel_stats, self.pending_channel_stats = self.pending_channel_stats, deque(maxlen=self.max_pending_stats)
+            if self.dropped_request_stats or self.dropped_channel_stats:
+                logger.warning(f"Stats buffer full, dropped {self.dropped_request_stats} request stats and {self.dropped_channel_stats} channel stats")
+                self.dropped_request_stats = self.dropped_channel_stats = 0
+            async with async_session() as session:
+                async with session.begin():
+                    try:
+                        if request_stats:
+                            await session.execute(insert(RequestStat), [
+                                {
+                                    "endpoint": endpoint,
+                                    "ip": client_ip,
+                                    "token": token,
+                                    "total_time": process_time,
+                                    "model": model,
+                                    "is_flagged": is_flagged,
+                                    "moderated_content": moderated_content,
+                                    "timestamp": datetime.fromtimestamp(timestamp, timezone.utc),
+                                } for endpoint, client_ip, token, process_time, model, is_flagged, moderated_content, timestamp in request_stats
+                            ])
+                        if channel_stats:
+                            await session.execute(insert(ChannelStat), [
+                                {
+                                    "provider": provider,
+                                    "model": model,
+                                    "api_key": api_key,
+                                    "success": success,
+                                    "first_response_time": first_response_time,
+                                    "timestamp": datetime.fromtimestamp(timestamp, timezone.utc),
+                                } for provider, model, api_key, success, first_response_time, timestamp in channel_stats
+                            ])
+                        await session.commit()
+                    except Exception as e:
+                        await session.rollback()
+                        logger.error(f"Error updating stats: {str(e)}")
+
+    async def flush_stats_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            # 关闭时取消定时任务不会打断正在进行的写库，已交换出的缓冲区不会丢失
+            await asyncio.shield(self.flush_stats())
 
     async def moderate_content(self, content, token):
         moderation_request = ModerationRequest(input=content)
@@ -292,45 +366,34 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有头部字段
 )
 
-app.add_middleware(StatsMiddleware)
+app.add_middleware(StatsMiddleware, app_state=app.state)
+
+# 设置 ENABLE_PROFILING 后，请求带上 ?profile=1 时返回该请求的 pyinstrument 性能分析报告
+# 最后注册，位于最外层，可以统计到 StatsMiddleware 的开销
+if os.getenv("ENABLE_PROFILING"):
+    from pyinstrument import Profiler
+    from fastapi.responses import HTMLResponse
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        if not request.query_params.get("profile"):
+            return await call_next(request)
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        response = await call_next(request)
+        # 读完响应体，流式响应的耗时也计入报告
+        async for _ in response.body_iterator:
+            pass
+        profiler.stop()
+        return HTMLResponse(profiler.output_html())
 
 # 在 process_request 函数中更新成功和失败计数
 async def process_request(request: Union[RequestModel, ImageGenerationRequest, AudioTranscriptionRequest, ModerationRequest], provider: Dict, endpoint=None, token=None):
-    url = provider['base_url']
-    parsed_url = urlparse(url)
-    # print("parsed_url", parsed_url)
-    engine = None
-    if parsed_url.netloc == 'generativelanguage.googleapis.com':
-        engine = "gemini"
-    elif parsed_url.netloc == 'aiplatform.googleapis.com':
-        engine = "vertex"
-    elif parsed_url.netloc == 'api.cloudflare.com':
-        engine = "cloudflare"
-    elif parsed_url.netloc == 'api.anthropic.com' or parsed_url.path.endswith("v1/messages"):
-        engine = "claude"
-    elif parsed_url.netloc == 'openrouter.ai':
-        engine = "openrouter"
-    elif parsed_url.netloc == 'api.cohere.com':
-        engine = "cohere"
+    engine = provider['_engines'][request.model]
+    if engine == "cohere":
         request.stream = True
-    else:
-        engine = "gpt"
 
-    if "claude" not in provider['model'][request.model] \
-    and "gpt" not in provider['model'][request.model] \
-    and "gemini" not in provider['model'][request.model] \
-    and parsed_url.netloc != 'api.cloudflare.com' \
-    and parsed_url.netloc != 'api.cohere.com':
-        engine = "openrouter"
-
-    if "claude" in provider['model'][request.model] and engine == "vertex":
-        engine = "vertex-claude"
-
-    if "gemini" in provider['model'][request.model] and engine == "vertex":
-        engine = "vertex-gemini"
-
-    if "o1-preview" in provider['model'][request.model] or "o1-mini" in provider['model'][request.model]:
-        engine = "o1"
+    if engine == "o1":
         request.stream = False
 
     if endpoint == "/v1/images/generations":
@@ -364,24 +427,26 @@ async def process_request(request: Union[RequestModel, ImageGenerationRequest, A
             wrapped_generator, first_response_time = await error_handling_wrapper(generator)
             response = StreamingResponse(wrapped_generator, media_type="text/event-stream")
         else:
-            generator = fetch_response(app.state.client, url, headers, payload)
-            wrapped_generator, first_response_time = await error_handling_wrapper(generator)
-            first_element = await anext(wrapped_generator)
-            first_element = first_element.lstrip("data: ")
-            first_element = json.loads(first_element)
-            response = JSONResponse(first_element)
+            first_element, first_response_time = await error_handling_response(fetch_response_one(app.state.client, url, headers, payload))
+            response = FastJSONResponse(first_element)
 
         # 更新成功计数和首次响应时间
-        await app.middleware_stack.app.update_channel_stats(provider['provider'], request.model, token, success=True, first_response_time=first_response_time)
+        app.state.stats_middleware.update_channel_stats(provider['provider'], request.model, token, success=True, first_response_time=first_response_time)
 
         return response
     except (Exception, HTTPException, asyncio.CancelledError, httpx.ReadError, httpx.RemoteProtocolError) as e:
         # 更新失败计数,首次响应时间为-1表示失败
-        await app.middleware_stack.app.update_channel_stats(provider['provider'], request.model, token, success=False, first_response_time=-1)
+        app.state.stats_middleware.update_channel_stats(provider['provider'], request.model, token, success=False, first_response_time=-1)
 
         raise e
 
 def weighted_round_robin(weights):
+    # 同一组权重生成的序列总是相同的，按 (渠道, 权重) 元组缓存
+    return list(_weighted_round_robin(tuple(weights.items())))
+
+@lru_cache(maxsize=128)
+def _weighted_round_robin(weight_items):
+    weights = dict(weight_items)
     provider_names = list(weights.keys())
     current_weights = {name: 0 for name in provider_names}
     num_selections = total_weight = sum(weights.values())
@@ -402,69 +467,20 @@ def weighted_round_robin(weights):
         weighted_provider_list.append(selected_letter)
         current_weights[selected_letter] -= total_weight
 
-    return weighted_provider_list
+    return tuple(weighted_provider_list)
 
 import asyncio
 class ModelRequestHandler:
     def __init__(self):
-        self.last_provider_index = -1
+        # 按 (token, model) 分别记录上次使用的渠道下标，不同 key 和模型的轮询互不干扰
+        self.last_provider_indices = {}
 
-    def get_matching_providers(self, model_name, token):
-        config = app.state.config
-        # api_keys_db = app.state.api_keys_db
-        api_list = app.state.api_list
-        api_index = api_list.index(token)
-        if not safe_get(config, 'api_keys', api_index, 'model'):
+    def get_matching_providers(self, model_name, api_index):
+        if not safe_get(app.state.config, 'api_keys', api_index, 'model'):
             raise HTTPException(status_code=404, detail="No matching model found")
-        provider_rules = []
-
-        for model in config['api_keys'][api_index]['model']:
-            if "/" in model:
-                if model.startswith("<") and model.endswith(">"):
-                    model = model[1:-1]
-                    # 处理带斜杠的模型名
-                    for provider in config['providers']:
-                        if model in provider['model'].keys():
-                            provider_rules.append(provider['provider'] + "/" + model)
-                else:
-                    provider_name = model.split("/")[0]
-                    model_name_split = "/".join(model.split("/")[1:])
-                    models_list = []
-                    for provider in config['providers']:
-                        if provider['provider'] == provider_name:
-                            models_list.extend(list(provider['model'].keys()))
-                    # print("models_list", models_list)
-                    # print("model_name", model_name)
-                    # print("model", model)
-                    if (model_name_split and model_name in models_list) or (model_name_split == "*" and model_name in models_list):
-                        provider_rules.append(provider_name)
-            else:
-                for provider in config['providers']:
-                    if model in provider['model'].keys():
-                        provider_rules.append(provider['provider'] + "/" + model)
-
-        provider_list = []
-        # print("provider_rules", provider_rules)
-        for item in provider_rules:
-            for provider in config['providers']:
-                # print("provider", provider, provider['provider'] == item, item)
-                if "/" in item:
-                    if provider['provider'] == item.split("/")[0]:
-                        if model_name in provider['model'].keys() and "/".join(item.split("/")[1:]) == model_name:
-                            provider_list.append(provider)
-                elif provider['provider'] == item:
-                    if model_name in provider['model'].keys():
-                        provider_list.append(provider)
-                else:
-                    pass
-
-                # if provider['provider'] == item:
-                #     if "/" in item:
-                #         if item.split("/")[1] == model_name:
-                #             provider_list.append(provider)
-                #     else:
-                #         if model_name in provider['model'].keys():
-                #             provider_list.append(provider)
+
+        # 渠道匹配结果在配置加载时已预先计算
+        provider_list = app.state.provider_index[api_index].get(model_name, [])
         if is_debug:
             for provider in provider_list:
                 logger.info("available provider: %s", json.dumps(provider, indent=4, ensure_ascii=False, default=circular_list_encoder))
@@ -473,17 +489,16 @@ class ModelRequestHandler:
     async def request_model(self, request: Union[RequestModel, ImageGenerationRequest, AudioTranscriptionRequest, ModerationRequest], token: str, endpoint=None):
         config = app.state.config
         # api_keys_db = app.state.api_keys_db
-        api_list = app.state.api_list
+        api_index = app.state.api_index_map[token]
 
         model_name = request.model
-        matching_providers = self.get_matching_providers(model_name, token)
+        matching_providers = self.get_matching_providers(model_name, api_index)
         # import json
         # print("matching_providers", json.dumps(matching_providers, indent=4, ensure_ascii=False))
         if not matching_providers:
             raise HTTPException(status_code=404, detail="No matching model found")
 
         # 检查是否启用轮询
-        api_index = api_list.index(token)
         weights = safe_get(config, 'api_keys', api_index, "weights")
         if weights:
             # 步骤 1: 提取 matching_providers 中的所有 provider 值
@@ -494,12 +509,10 @@ class ModelRequestHandler:
             intersection = providers.intersection(weight_keys)
             weights = dict(filter(lambda item: item[0] in intersection, weights.items()))
             weighted_provider_name_list = weighted_round_robin(weights)
-            new_matching_providers = []
-            for provider_name in weighted_provider_name_list:
-                for provider in matching_providers:
-                    if provider['provider'] == provider_name:
-                        new_matching_providers.append(provider)
-            matching_providers = new_matching_providers
+            providers_by_name = defaultdict(list)
+            for provider in matching_providers:
+                providers_by_name[provider['provider']].append(provider)
+            matching_providers = [provider for provider_name in weighted_provider_name_list for provider in providers_by_name[provider_name]]
 
         # import json
         # print("matching_providers", json.dumps(matching_providers, indent=4, ensure_ascii=False, default=circular_list_encoder))
@@ -517,10 +530,11 @@ class ModelRequestHandler:
         status_code = 500
         error_message = None
         num_providers = len(providers)
-        start_index = self.last_provider_index + 1 if use_round_robin else 0
-        for i in range(num_providers + 1):
-            self.last_provider_index = (start_index + i) % num_providers
-            provider = providers[self.last_provider_index]
+        round_robin_key = (token, request.model)
+        start_index = (self.last_provider_indices.get(round_robin_key, -1) + 1) % num_providers if use_round_robin else 0
+        # 从 start_index 开始依次尝试每个渠道一次，记录的下标在下次取用时再取模
+        for provider_index, provider in enumerate(islice(cycle(providers), start_index, start_index + num_providers), start_index):
+            self.last_provider_indices[round_robin_key] = provider_index
             try:
                 response = await process_request(request, provider, endpoint, token)
                 return response
@@ -548,19 +562,21 @@ class ModelRequestHandler:
 
 model_handler = ModelRequestHandler()
 
+# 定义时间单位到秒的映射
+RATE_LIMIT_TIME_UNITS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': 60, 'min': 60, 'minute': 60,
+    'h': 3600, 'hr': 3600, 'hour': 3600,
+    'd': 86400, 'day': 86400,
+    'mo': 2592000, 'month': 2592000,
+    'y': 31536000, 'year': 31536000
+}
+RATE_LIMIT_PATTERN = re.compile(r'^(\d+)/(\w+)$')
+
+@lru_cache(maxsize=128)
 def parse_rate_limit(limit_string):
-    # 定义时间单位到秒的映射
-    time_units = {
-        's': 1, 'sec': 1, 'second': 1,
-        'm': 60, 'min': 60, 'minute': 60,
-        'h': 3600, 'hr': 3600, 'hour': 3600,
-        'd': 86400, 'day': 86400,
-        'mo': 2592000, 'month': 2592000,
-        'y': 31536000, 'year': 31536000
-    }
-
     # 使用正则表达式匹配数字和单位
-    match = re.match(r'^(\d+)/(\w+)$', limit_string)
+    match = RATE_LIMIT_PATTERN.match(limit_string)
     if not match:
         raise ValueError(f"Invalid rate limit format: {limit_string}")
 
@@ -568,51 +584,68 @@ def parse_rate_limit(limit_string):
     count = int(count)
 
     # 转换单位到秒
-    if unit not in time_units:
+    if unit not in RATE_LIMIT_TIME_UNITS:
         raise ValueError(f"Unknown time unit: {unit}")
 
-    seconds = time_units[unit]
+    seconds = RATE_LIMIT_TIME_UNITS[unit]
 
     return (count, seconds)
 
 class InMemoryRateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
+    def __init__(self, cleanup_interval=60):
+        # 每个 key 保存自己的限流周期和请求时间队列：{key: (period, deque)}
+        self.requests = {}
+        self.cleanup_interval = cleanup_interval
+        self.last_cleanup = time_module.time()
 
     async def is_rate_limited(self, key: str, limit: int, period: int) -> bool:
         now = time_module.time()
-        self.requests[key] = [req for req in self.requests[key] if req > now - period]
-        if len(self.requests[key]) >= limit:
+        if now - self.last_cleanup >= self.cleanup_interval:
+            self.cleanup(now)
+        entry = self.requests.get(key)
+        requests = entry[1] if entry else deque()
+        # 配置重新加载后周期可能变化，始终记录最新的周期
+        self.requests[key] = (period, requests)
+        # 请求时间按先后顺序追加，只需从队头弹出已过期的记录
+        while requests and requests[0] <= now - period:
+            requests.popleft()
+        if len(requests) >= limit:
             return True
-        self.requests[key].append(now)
+        requests.append(now)
         return False
 
-rate_limiter = InMemoryRateLimiter()
+    def cleanup(self, now: float):
+        # 按固定间隔删除最近一次请求已超出各自限流周期的 key，避免不同 IP 产生的 key 无限累积
+        expired_keys = [key for key, (period, requests) in self.requests.items() if not requests or requests[-1] <= now - period]
+        for key in expired_keys:
+            del self.requests[key]
+        self.last_cleanup = now
 
-async def get_user_rate_limit(api_index: str = None):
-    # 这里应该实现根据 token 获取用户速率限制的逻辑
-    # 示例： 返回 (次数， 秒数)
-    config = app.state.config
-    raw_rate_limit = safe_get(config, 'api_keys', api_index, "preferences", "RATE_LIMIT")
+rate_limiter = InMemoryRateLimiter()
 
-    if not api_index or not raw_rate_limit:
-        return (30, 60)
+DEFAULT_RATE_LIMIT = (30, 60)
 
-    rate_limit = parse_rate_limit(raw_rate_limit)
-    return rate_limit
+def get_rate_limits(config):
+    # 配置加载时预先解析每个 token 的速率限制：{token: (次数, 秒数)}
+    rate_limits = {}
+    for api_key in safe_get(config, 'api_keys', default=[]):
+        raw_rate_limit = safe_get(api_key, "preferences", "RATE_LIMIT")
+        if not raw_rate_limit or api_key['api'] in rate_limits:
+            continue
+        try:
+            rate_limits[api_key['api']] = parse_rate_limit(raw_rate_limit)
+        except ValueError as e:
+            logger.error(f"Invalid RATE_LIMIT for api key, using default: {e}")
+    return rate_limits
 
 security = HTTPBearer()
 
 async def rate_limit_dependency(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials if credentials else None
-    api_list = app.state.api_list
-    try:
-        api_index = api_list.index(token)
-    except ValueError:
+    if token not in app.state.api_index_map:
         print("error: Invalid or missing API Key:", token)
-        api_index = None
         token = None
-    limit, period = await get_user_rate_limit(api_index)
+    limit, period = app.state.rate_limits.get(token, DEFAULT_RATE_LIMIT)
 
     # 使用 IP 地址和 token（如果有）作为限制键
     client_ip = request.client.host
@@ -622,21 +655,19 @@ async def rate_limit_dependency(request: Request, credentials: HTTPAuthorization
         raise HTTPException(status_code=429, detail="Too many requests")
 
 def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    api_list = app.state.api_list
+    api_index_map = app.state.api_index_map
     token = credentials.credentials
-    if token not in api_list:
+    if token not in api_index_map:
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
     return token
 
 def verify_admin_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    api_list = app.state.api_list
+    api_index_map = app.state.api_index_map
     token = credentials.credentials
-    if token not in api_list:
+    if token not in api_index_map:
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
-    for api_key in app.state.api_keys_db:
-        if api_key['api'] == token:
-            if api_key.get('role') != "admin":
-                raise HTTPException(status_code=403, detail="Permission denied")
+    if token not in app.state.admin_tokens:
+        raise HTTPException(status_code=403, detail="Permission denied")
     return token
 
 @app.post("/v1/chat/completions", dependencies=[Depends(rate_limit_dependency)])
@@ -646,12 +677,12 @@ async def request_model(request: RequestModel, token: str = Depends(verify_api_k
 
 @app.options("/v1/chat/completions", dependencies=[Depends(rate_limit_dependency)])
 async def options_handler():
-    return JSONResponse(status_code=200, content={"detail": "OPTIONS allowed"})
+    return FastJSONResponse(status_code=200, content={"detail": "OPTIONS allowed"})
 
 @app.get("/v1/models", dependencies=[Depends(rate_limit_dependency)])
 async def list_models(token: str = Depends(verify_api_key)):
-    models = post_all_models(token, app.state.config, app.state.api_list)
-    return JSONResponse(content={
+    models = post_all_models(token, app.state.config, app.state.api_index_map)
+    return FastJSONResponse(content={
         "object": "list",
         "data": models
     })
@@ -705,14 +736,30 @@ def generate_api_key():
     # Generate a random string of 36 characters
     random_string = ''.join(secrets.choice(chars) for _ in range(36))
     api_key = "sk-" + random_string
-    return JSONResponse(content={"api_key": api_key})
+    return FastJSONResponse(content={"api_key": api_key})
 
 # 在 /stats 路由中返回成功和失败百分比
 from collections import defaultdict
 from sqlalchemy import func, desc, case
 
-@app.get("/stats", dependencies=[Depends(rate_limit_dependency)])
-async def get_stats(request: Request, token: str = Depends(verify_admin_api_key)):
+# /stats 结果缓存的有效期（秒），轮询的客户端在有效期内直接复用同一份快照
+STATS_CACHE_TTL = 1.0
+stats_cache = {"time": 0.0, "stats": None}
+stats_cache_lock = asyncio.Lock()
+
+async def get_stats_snapshot():
+    if stats_cache["stats"] is not None and time() - stats_cache["time"] < STATS_CACHE_TTL:
+        return stats_cache["stats"]
+    async with stats_cache_lock:
+        # 等锁期间可能已经有其他请求算好了
+        if stats_cache["stats"] is not None and time() - stats_cache["time"] < STATS_CACHE_TTL:
+            return stats_cache["stats"]
+        stats = await compute_stats()
+        stats_cache["stats"] = stats
+        stats_cache["time"] = time()
+        return stats
+
+async def compute_stats():
     async with async_session() as session:
         # 1. 每个渠道下面每个模型的成功率
         channel_model_stats = await session.execute(
@@ -759,21 +806,27 @@ async def get_stats(request: Request, token: str = Depends(verify_admin_api_key)
         )
         ip_stats = ip_stats.fetchall()
 
+    # 成功率每行只算一次，排序直接使用算好的值
+    channel_model_success_rates = [
+        {
+            "provider": stat.provider,
+            "model": stat.model,
+            "success_rate": stat.success_count / stat.total if stat.total > 0 else 0
+        } for stat in channel_model_stats
+    ]
+    channel_model_success_rates.sort(key=itemgetter("success_rate"), reverse=True)
+    channel_success_rates = [
+        {
+            "provider": stat.provider,
+            "success_rate": stat.success_count / stat.total if stat.total > 0 else 0
+        } for stat in channel_stats
+    ]
+    channel_success_rates.sort(key=itemgetter("success_rate"), reverse=True)
+
     # 处理统计数据并返回
     stats = {
-        "channel_model_success_rates": [
-            {
-                "provider": stat.provider,
-                "model": stat.model,
-                "success_rate": stat.success_count / stat.total if stat.total > 0 else 0
-            } for stat in sorted(channel_model_stats, key=lambda x: x.success_count / x.total if x.total > 0 else 0, reverse=True)
-        ],
-        "channel_success_rates": [
-            {
-                "provider": stat.provider,
-                "success_rate": stat.success_count / stat.total if stat.total > 0 else 0
-            } for stat in sorted(channel_stats, key=lambda x: x.success_count / x.total if x.total > 0 else 0, reverse=True)
-        ],
+        "channel_model_success_rates": channel_model_success_rates,
+        "channel_success_rates": channel_success_rates,
         "model_request_counts": [
             {
                 "model": stat.model,
@@ -793,8 +846,12 @@ async def get_stats(request: Request, token: str = Depends(verify_admin_api_key)
             } for stat in ip_stats
         ]
     }
+    return stats
 
-    return JSONResponse(content=stats)
+@app.get("/stats", dependencies=[Depends(rate_limit_dependency)])
+async def get_stats(request: Request, token: str = Depends(verify_admin_api_key)):
+    stats = await get_stats_snapshot()
+    return FastJSONResponse(content=stats)
 
 # async def on_fetch(request, env):
 #     import asgi
@@ -269,7 +269,7 @@ async def fetch_claude_response_stream(client, url, headers, payload, model):
                         yield sse_string
         yield "data: [DONE]\n\r\n"
 
-async def fetch_response(client, url, headers, payload):
+async def fetch_response_one(client, url, headers, payload):
     response = None
     if payload.get("file"):
         file = payload.pop("file")
@@ -278,9 +278,8 @@ async def fetch_response(client, url, headers, payload):
         response = await client.post(url, headers=headers, json=payload)
     error_message = await check_response(response, "fetch_response")
     if error_message:
-        yield error_message
-        return
-    yield response.json()
+        return error_message
+    return response.json()
 
 async def fetch_response_stream(client, url, headers, payload, engine, model):
     try:
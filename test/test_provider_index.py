@@ -0,0 +1,85 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import update_config, build_provider_index, get_engine, get_model_engine
+
+def make_config(api_models):
+    config = {
+        "providers": [
+            {"provider": "openai", "base_url": "https://api.openai.com/v1/chat/completions", "api": "sk-1", "model": ["gpt-4o", {"gpt-4o-mini": "mini"}]},
+            {"provider": "openai", "base_url": "https://api.openai.com/v1/chat/completions", "api": "sk-2", "model": ["gpt-4o", "o1-mini"]},
+            {"provider": "claude", "base_url": "https://api.anthropic.com/v1/messages", "api": "sk-3", "model": ["claude-3-5-sonnet", "gpt-4o"]},
+            {"provider": "groq", "base_url": "https://api.groq.com/openai/v1/chat/completions", "api": "sk-4", "model": ["meta/llama-3"]},
+        ],
+        "api_keys": [{"api": "sk-user", "model": api_models}],
+    }
+    config, _, _ = update_config(config)
+    return config
+
+def index_for(api_models):
+    config = make_config(api_models)
+    return config, build_provider_index(config)[0]
+
+def test_plain_model():
+    config, index = index_for(["gpt-4o"])
+    assert list(index) == ["gpt-4o"]
+    providers = config["providers"]
+    assert index["gpt-4o"] == [providers[0], providers[1], providers[2]]
+
+def test_plain_model_uses_alias():
+    config, index = index_for(["mini"])
+    assert index == {"mini": [config["providers"][0]]}
+
+def test_provider_wildcard():
+    config, index = index_for(["openai/*"])
+    providers = config["providers"]
+    assert index == {
+        "gpt-4o": [providers[0], providers[1]],
+        "mini": [providers[0]],
+        "o1-mini": [providers[1]],
+    }
+
+def test_provider_model_selects_all_models_of_provider():
+    config, index = index_for(["claude/claude-3-5-sonnet"])
+    providers = config["providers"]
+    assert index == {"claude-3-5-sonnet": [providers[2]], "gpt-4o": [providers[2]]}
+
+def test_bracketed_model_with_slash():
+    config, index = index_for(["<meta/llama-3>"])
+    assert index == {"meta/llama-3": [config["providers"][3]]}
+
+def test_provider_with_empty_model_is_ignored():
+    _, index = index_for(["openai/"])
+    assert index == {}
+
+def test_duplicate_matches_are_deduped_in_first_match_order():
+    config, index = index_for(["claude/*", "gpt-4o", "openai/*"])
+    providers = config["providers"]
+    assert index["gpt-4o"] == [providers[2], providers[0], providers[1]]
+
+def test_engine_netloc_and_v1_messages_precedence():
+    # 已知域名优先于 v1/messages 路径，gpt、openrouter、cohere 域名下 v1/messages 使用 claude
+    assert get_engine({"base_url": "https://api.anthropic.com/v1/messages"}) == "claude"
+    assert get_engine({"base_url": "https://proxy.example.com/v1/messages"}) == "claude"
+    assert get_engine({"base_url": "https://openrouter.ai/api/v1/messages"}) == "claude"
+    assert get_engine({"base_url": "https://api.cohere.com/v1/messages"}) == "claude"
+    assert get_engine({"base_url": "https://api.cloudflare.com/v1/messages"}) == "cloudflare"
+    assert get_engine({"base_url": "https://generativelanguage.googleapis.com/v1/messages"}) == "gemini"
+    assert get_engine({"base_url": "https://aiplatform.googleapis.com/v1/messages"}) == "vertex"
+    assert get_engine({"base_url": "https://api.openai.com/v1/chat/completions"}) == "gpt"
+    assert get_engine({}) == "gpt"
+
+def test_model_engine():
+    assert get_model_engine("gpt", "llama-3", "api.groq.com") == "openrouter"
+    assert get_model_engine("claude", "command-r", "api.cohere.com") == "claude"
+    assert get_model_engine("cloudflare", "llama-3", "api.cloudflare.com") == "cloudflare"
+    assert get_model_engine("vertex", "claude-3-5-sonnet", "aiplatform.googleapis.com") == "vertex-claude"
+    assert get_model_engine("vertex", "gemini-1.5-pro", "aiplatform.googleapis.com") == "vertex-gemini"
+    assert get_model_engine("gpt", "o1-mini", "api.openai.com") == "o1"
+
+def test_update_config_precomputes_engines():
+    config = make_config(["gpt-4o"])
+    providers = config["providers"]
+    assert providers[0]["_engines"] == {"gpt-4o": "gpt", "mini": "gpt"}
+    assert providers[1]["_engines"] == {"gpt-4o": "gpt", "o1-mini": "o1"}
+    assert providers[2]["_engines"] == {"claude-3-5-sonnet": "claude", "gpt-4o": "claude"}
@@ -1,6 +1,8 @@
 import json
 from fastapi import HTTPException
 import httpx
+from collections import defaultdict
+from urllib.parse import urlparse
 
 from log_config import logger
 
@@ -17,6 +19,10 @@ def update_config(config_data):
             provider['base_url'] = 'https://aiplatform.googleapis.com/'
         if provider.get('cf_account_id'):
             provider['base_url'] = 'https://api.cloudflare.com/'
+        # 每个模型使用的引擎只取决于配置，加载时算好
+        engine = get_engine(provider)
+        netloc = urlparse(provider.get('base_url', '')).netloc
+        provider['_engines'] = {model: get_model_engine(engine, original_model, netloc) for model, original_model in provider['model'].items()}
 
         if provider.get('api'):
             if isinstance(provider.get('api'), str):
@@ -49,6 +55,83 @@ def update_config(config_data):
     # logger.info(json.dumps(config_data, indent=4, ensure_ascii=False, default=circular_list_encoder))
     return config_data, api_keys_db, api_list
 
+# 域名到默认引擎的映射
+NETLOC_ENGINES = {
+    'generativelanguage.googleapis.com': "gemini",
+    'aiplatform.googleapis.com': "vertex",
+    'api.cloudflare.com': "cloudflare",
+    'api.anthropic.com': "claude",
+    'openrouter.ai': "openrouter",
+    'api.cohere.com': "cohere",
+}
+
+# 根据 base_url 确定渠道的默认引擎，配置加载时计算一次
+def get_engine(provider):
+    parsed_url = urlparse(provider.get('base_url', ''))
+    engine = NETLOC_ENGINES.get(parsed_url.netloc, "gpt")
+    # 以 v1/messages 结尾的地址使用 claude 格式，但 gemini、vertex、cloudflare 的域名优先
+    if parsed_url.path.endswith("v1/messages") and engine in ("gpt", "openrouter", "cohere"):
+        engine = "claude"
+    return engine
+
+# 根据渠道默认引擎、实际模型名和 base_url 域名确定该模型使用的引擎
+def get_model_engine(engine, original_model, netloc):
+    # 按域名判断而不是按引擎判断：cohere 域名下以 v1/messages 结尾的地址引擎是 claude，也不能改为 openrouter
+    if "claude" not in original_model \
+    and "gpt" not in original_model \
+    and "gemini" not in original_model \
+    and netloc != 'api.cloudflare.com' \
+    and netloc != 'api.cohere.com':
+        engine = "openrouter"
+
+    if "claude" in original_model and engine == "vertex":
+        engine = "vertex-claude"
+
+    if "gemini" in original_model and engine == "vertex":
+        engine = "vertex-gemini"
+
+    if "o1-preview" in original_model or "o1-mini" in original_model:
+        engine = "o1"
+
+    return engine
+
+# 预先计算每个 api key 下模型名到可用渠道列表的映射：{api_index: {model_name: [provider, ...]}}
+def build_provider_index(config):
+    provider_index = {}
+    if not config:
+        return provider_index
+
+    # 同名渠道可能有多个，按配置顺序分组
+    providers_by_name = defaultdict(list)
+    for provider in config['providers']:
+        providers_by_name[provider['provider']].append(provider)
+
+    for api_index, api_key in enumerate(config['api_keys']):
+        # 以 id(provider) 为键去重，同时保留第一次匹配的顺序
+        model_index = defaultdict(dict)
+        for model in api_key.get('model') or []:
+            if "/" in model and model.startswith("<") and model.endswith(">"):
+                # 处理带斜杠的模型名
+                model = model[1:-1]
+            elif "/" in model:
+                provider_name, _, model_name_split = model.partition("/")
+                if not model_name_split:
+                    continue
+                for provider in providers_by_name.get(provider_name, []):
+                    for model_name in provider['model']:
+                        model_index[model_name].setdefault(id(provider), provider)
+                continue
+
+            for provider in config['providers']:
+                if model not in provider['model']:
+                    continue
+                for item in providers_by_name[provider['provider']]:
+                    if model in item['model']:
+                        model_index[model].setdefault(id(item), item)
+
+        provider_index[api_index] = {model_name: list(providers.values()) for model_name, providers in model_index.items()}
+    return provider_index
+
 # 读取YAML配置文件
 async def load_config(app=None):
     import yaml
@@ -161,18 +244,28 @@ async def error_handling_wrapper(generator):
     except StopAsyncIteration:
         raise HTTPException(status_code=400, detail="data: {'error': 'No data returned'}")
 
-def post_all_models(token, config, api_list):
+async def error_handling_response(coroutine):
+    start_time = time_module.time()
+    response = await coroutine
+    first_response_time = time_module.time() - start_time
+    if isinstance(response, dict) and 'error' in response:
+        status_code = response.get('status_code', 500)
+        detail = response.get('details', f"{response}")
+        raise HTTPException(status_code=status_code, detail=f"{detail}"[:300])
+    return response, first_response_time
+
+def post_all_models(token, config, api_index_map):
     all_models = []
     unique_models = set()
 
-    if token not in api_list:
+    if token not in api_index_map:
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
-    api_index = api_list.index(token)
+    api_index = api_index_map[token]
     if config['api_keys'][api_index]['model']:
         for model in config['api_keys'][api_index]['model']:
-            if "/" in model:
-                provider = model.split("/")[0]
-                model = model.split("/")[1]
+            provider, slash, model_name = model.partition("/")
+            if slash:
+                model = model_name
                 if model == "*":
                     for provider_item in config["providers"]:
                         if provider_item['provider'] != provider: